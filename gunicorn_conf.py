@@ -0,0 +1,16 @@
+import multiprocessing
+import os
+
+# --- Gunicorn configuration for main:app ---
+# Requests spend most of their time waiting on GCS and Gemini, so each worker
+# runs many threads to overlap that I/O.
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+worker_class = "gthread"
+# Each worker is a full process with its own GCS I/O pool and Google client libraries,
+# so the CPU-based default is capped to keep memory in check on small Cloud Run instances.
+# WEB_CONCURRENCY overrides it.
+workers = int(os.environ.get("WEB_CONCURRENCY", min(2 * multiprocessing.cpu_count() + 1, 4)))
+threads = int(os.environ.get("GUNICORN_THREADS", 32))
+# With gthread workers this only restarts a worker whose main loop stops responding;
+# it does not limit how long an individual request (e.g. a Gemini call) may run.
+timeout = 120
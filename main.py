@@ -1,9 +1,26 @@
-from flask import Flask, request, render_template, redirect, url_for, flash, send_file, Response
-from google.cloud import storage
+from flask import Flask, request, render_template, redirect, url_for, flash, Response
+from google.cloud import storage, tasks_v2
+from google.cloud.exceptions import NotFound, PreconditionFailed
+import google.auth
+from google.auth.credentials import Signing
+import google.auth.transport.requests
+from google.oauth2 import id_token
+import cachecontrol
+import requests
+from requests.adapters import HTTPAdapter
 import google.generativeai as genai
+import vertexai
+from vertexai.batch_prediction import BatchPredictionJob
+import redis
 import os
-import json
+import hmac
+import orjson
 import io
+import mimetypes
+import time
+import uuid
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import logging # Import logging
 
@@ -18,11 +35,41 @@ app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'a-default-fallback-secret-k
 # --- Configuration ---
 # It's better to get the bucket name from an environment variable
 BUCKET_NAME = os.environ.get("GCS_BUCKET_NAME", "photos-app") # Use env var or default
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ALLOWED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'gif'})
+ALLOWED_SUFFIXES = tuple(f".{ext}" for ext in ALLOWED_EXTENSIONS) # For str.endswith
+# Number of concurrent GCS operations shared across all requests
+GCS_IO_WORKERS = int(os.environ.get("GCS_IO_WORKERS", 32))
+
+# Browsers are redirected to GCS with a short-lived signed URL instead of
+# proxying image bytes; set GCS_PUBLIC_BUCKET=true to use plain public URLs
+GCS_PUBLIC_BUCKET = os.environ.get("GCS_PUBLIC_BUCKET", "False").lower() == "true"
+SIGNED_URL_TTL = timedelta(minutes=15)
+# After a signing failure (e.g. missing roles/iam.serviceAccountTokenCreator), proxy for
+# this long before trying again, rather than making a failing IAM call on every request
+SIGNING_RETRY_DELAY = 600 # seconds
+signing_suspended_until = 0.0
+# Browsers may reuse a redirect (and so hit their cache for the same URL) while it is still valid
+REDIRECT_MAX_AGE = int(SIGNED_URL_TTL.total_seconds()) - 300
+# When a URL can't be signed, images are proxied to the browser in chunks of this size rather than buffered whole
+IMAGE_STREAM_CHUNK_SIZE = 256 * 1024
+
+# Shared pool for overlapping GCS round-trips; the storage client is thread-safe
+io_executor = ThreadPoolExecutor(max_workers=GCS_IO_WORKERS, thread_name_prefix="gcs-io")
+# Bulk admin jobs use their own short-lived pool of this size so they never queue ahead of user uploads
+BULK_WRITE_WORKERS = 8
+# Keep-alive connections to GCS; sized above GCS_IO_WORKERS so request threads don't wait on the pool
+GCS_HTTP_POOL_SIZE = 64
+# Bucket listings ask GCS for only the fields we read (partial response), in large pages
+GALLERY_LIST_FIELDS = "items(name,metadata),nextPageToken"
+LIST_PAGE_SIZE = 1000
 
 # --- Initialize Clients ---
 try:
-    storage_client = storage.Client()
+    # Share one pooled HTTP session so GCS calls reuse TLS connections across threads
+    credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+    gcs_session = google.auth.transport.requests.AuthorizedSession(credentials)
+    gcs_session.mount("https://", HTTPAdapter(pool_connections=GCS_HTTP_POOL_SIZE, pool_maxsize=GCS_HTTP_POOL_SIZE, max_retries=3))
+    storage_client = storage.Client(project=project, credentials=credentials, _http=gcs_session)
     bucket = storage_client.bucket(BUCKET_NAME)
     logging.info(f"Successfully connected to GCS bucket: {BUCKET_NAME}")
 except Exception as e:
@@ -31,20 +78,88 @@ except Exception as e:
     storage_client = None
     bucket = None
 
+# Separate credentials for signing image URLs: the IAM signBlob call needs the
+# cloud-platform scope, which the storage session's devstorage-only token lacks
+try:
+    signing_credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+except Exception as e:
+    logging.error(f"Failed to load signing credentials, images will be proxied: {e}")
+    signing_credentials = None
+
+# --- Initialize Redis cache (optional) ---
+REDIS_URL = os.environ.get("REDIS_URL")
+# The rendered gallery list is cached briefly and dropped whenever an upload changes it
+GALLERY_CACHE_KEY = "gallery:v1"
+GALLERY_CACHE_TTL = 45 # seconds
+redis_client = None
+if REDIS_URL:
+    try:
+        redis_client = redis.Redis.from_url(REDIS_URL)
+        logging.info("Redis cache enabled.")
+    except Exception as e:
+        logging.error(f"Failed to initialize Redis client, caching disabled: {e}")
+        redis_client = None
+
+# --- Initialize Cloud Tasks (optional) ---
+# When configured, uploads return as soon as the image is stored and the Gemini
+# description is generated by a task that calls back into /internal/describe.
+# The route is public, so each task carries an OIDC token for TASKS_SERVICE_ACCOUNT
+# (audience SERVICE_URL) and the handler verifies it before doing any work.
+TASKS_QUEUE = os.environ.get("CLOUD_TASKS_QUEUE") # projects/<p>/locations/<l>/queues/<q>
+SERVICE_URL = (os.environ.get("SERVICE_URL") or "").rstrip('/') # Public base URL of this service
+TASKS_SERVICE_ACCOUNT = os.environ.get("CLOUD_TASKS_SERVICE_ACCOUNT") # Identity the tasks authenticate as
+# Fetches Google's token-signing certificates through an HTTP cache that honours their
+# Cache-Control headers, so verifying a task token doesn't cost a round trip each time
+auth_request = google.auth.transport.requests.Request(session=cachecontrol.CacheControl(requests.Session()))
+tasks_client = None
+if TASKS_QUEUE and SERVICE_URL and TASKS_SERVICE_ACCOUNT:
+    try:
+        tasks_client = tasks_v2.CloudTasksClient()
+        logging.info(f"Cloud Tasks enabled on queue: {TASKS_QUEUE}")
+    except Exception as e:
+        logging.error(f"Failed to initialize Cloud Tasks client, describing inline: {e}")
+        tasks_client = None
+
 # --- Configure Gemini AI ---
+# Gemini tiles images to ~768px internally, so anything larger is wasted upload bytes
+GEMINI_MAX_IMAGE_EDGE = 1024
+GEMINI_JPEG_QUALITY = 85
+
+# Structured output schema; Gemini is constrained to exactly this JSON shape.
+# Enum names are upper-case so the same dict is valid for the Vertex batch API.
+DESCRIPTION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "title": {"type": "STRING"},
+        "description": {"type": "STRING"},
+    },
+    "required": ["title", "description"],
+}
+
+# Shared by the interactive model and batch prediction requests
+GENERATION_CONFIG = {
+    "temperature": 0.4,
+    "top_p": 1,
+    "top_k": 32,
+    "max_output_tokens": 4096, # Reduced for title/desc
+    "response_mime_type": "application/json", # Request JSON directly
+    "response_schema": DESCRIPTION_SCHEMA,
+}
+
+# Prompt for Gemini; the JSON shape is enforced by DESCRIPTION_SCHEMA.
+# Set once as the model's system instruction so each request only carries the image.
+PROMPT = """
+Analyze this image and provide a concise title and a short description.
+"""
+
 try:
     # It's crucial to get the API key from environment variables for security
     gemini_api_key = os.environ['GEMINI_API_KEY']
     genai.configure(api_key=gemini_api_key)
     model = genai.GenerativeModel(
         model_name="gemini-1.5-flash",
-        generation_config={
-            "temperature": 0.4,
-            "top_p": 1,
-            "top_k": 32,
-            "max_output_tokens": 4096, # Reduced for title/desc
-            "response_mime_type": "application/json", # Request JSON directly
-        }
+        generation_config=GENERATION_CONFIG,
+        system_instruction=PROMPT,
     )
     logging.info("Successfully configured Gemini AI model.")
 except KeyError:
@@ -54,69 +169,204 @@ except Exception as e:
     logging.error(f"Failed to configure Gemini AI: {e}")
     model = None
 
-# Prompt for Gemini, asking specifically for JSON output
-PROMPT = """
-Analyze this image and provide a concise title and a short description.
-Return the output strictly in the following JSON format:
-{
-  "title": "Your Image Title",
-  "description": "Your image description."
-}
-Do not include any other text or formatting outside the JSON structure.
-"""
+# --- Configure Vertex AI (batch reprocessing) ---
+# Batch prediction needs a pinned model version; jobs read/write under BATCH_PREFIX in the bucket
+BATCH_MODEL = os.environ.get("BATCH_MODEL", "gemini-1.5-flash-002")
+BATCH_PREFIX = "batch/"
+# Bearer token required by the admin routes (batch reprocessing); they are disabled when unset
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+try:
+    vertexai.init(
+        project=os.environ.get("GOOGLE_CLOUD_PROJECT"),
+        location=os.environ.get("VERTEX_LOCATION", "us-central1"),
+    )
+    vertex_ready = True
+    logging.info("Successfully configured Vertex AI for batch prediction.")
+except Exception as e:
+    logging.error(f"Failed to configure Vertex AI, batch reprocessing disabled: {e}")
+    vertex_ready = False
 
 def allowed_file(filename):
     """Checks if the filename has an allowed extension."""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    dot = filename.rfind('.')
+    return dot != -1 and filename[dot + 1:].lower() in ALLOWED_EXTENSIONS
 
-def process_image_with_gemini(image_bytes):
+def parse_description(text, raise_on_error=False):
+    """
+    Parse Gemini's JSON text into a title/description dict.
+    The response schema guarantees the shape, so only truncated or otherwise
+    malformed output falls back to a placeholder dict (or raises, with raise_on_error).
+    """
+    try:
+        json_data = orjson.loads(text)
+        logging.info(f"Successfully parsed Gemini JSON: {json_data}")
+        return {"title": json_data["title"], "description": json_data["description"]}
+    except orjson.JSONDecodeError as e:
+        logging.error(f"Failed to decode Gemini JSON response: {e}. Response text: {text}")
+        if raise_on_error:
+            raise
+        # Fallback if JSON parsing fails
+        return {"title": "Processing Error", "description": f"Could not parse AI response: {text[:100]}..."} # Show partial response
+    except Exception as e_inner: # Catch other potential errors during parsing/validation
+         logging.error(f"Error processing Gemini response content: {e_inner}. Response text: {text}")
+         if raise_on_error:
+             raise
+         return {"title": "Processing Error", "description": f"Error processing AI response: {str(e_inner)}"}
+
+def save_description(filename, description_data, if_generation_match=None, invalidate=True):
+    """
+    Stores the title/description in the image blob's custom metadata, so
+    listing the bucket returns it without fetching a second object.
+    With if_generation_match, raises PreconditionFailed if the image has been
+    replaced since that generation. Bulk callers pass invalidate=False and
+    drop the gallery cache once themselves.
+    """
+    img_blob = bucket.blob(filename)
+    img_blob.metadata = {
+        "title": str(description_data.get("title", "Untitled")),
+        "description": str(description_data.get("description", "")),
+    }
+    img_blob.patch(if_generation_match=if_generation_match)
+    logging.info(f"Successfully stored description metadata for '{filename}' in GCS.")
+    if invalidate:
+        invalidate_gallery_cache()
+
+def load_description(filename):
+    """
+    Returns the title/description dict for an image, or None if it has none.
+    Raises NotFound if the image itself doesn't exist. Images not yet moved by
+    /admin/migrate_descriptions fall back to their old JSON sidecar.
+    """
+    img_blob = bucket.get_blob(filename)
+    if img_blob is None:
+        raise NotFound(f"Image {filename} not found.")
+
+    metadata = img_blob.metadata or {}
+    if 'title' in metadata:
+        return {"title": metadata['title'], "description": metadata.get('description', '')}
+
+    base_name = os.path.splitext(filename)[0]
+    try:
+        return orjson.loads(bucket.blob(f"{base_name}_description.json").download_as_string())
+    except NotFound:
+        return None
+
+def enqueue_description(filename):
+    """Creates a Cloud Task that generates the description for an uploaded image."""
+    http_request = {
+        "http_method": tasks_v2.HttpMethod.POST,
+        "url": f"{SERVICE_URL}{url_for('describe_image', filename=filename)}",
+        "oidc_token": {"service_account_email": TASKS_SERVICE_ACCOUNT, "audience": SERVICE_URL},
+    }
+    task = tasks_client.create_task(parent=TASKS_QUEUE, task={"http_request": http_request})
+    logging.info(f"Enqueued description task {task.name} for '{filename}'.")
+
+def is_admin_caller():
+    """Checks the request carries ADMIN_TOKEN as a bearer token."""
+    if not ADMIN_TOKEN:
+        return False
+    auth_header = request.headers.get('Authorization', '')
+    return hmac.compare_digest(auth_header.encode(), f"Bearer {ADMIN_TOKEN}".encode())
+
+def is_task_caller():
+    """Checks the request's bearer token is a Google-signed OIDC token for TASKS_SERVICE_ACCOUNT."""
+    auth_header = request.headers.get('Authorization', '')
+    if not TASKS_SERVICE_ACCOUNT or not auth_header.startswith('Bearer '):
+        return False
+    try:
+        claims = id_token.verify_oauth2_token(auth_header[len('Bearer '):], auth_request, audience=SERVICE_URL)
+    except ValueError as e:
+        logging.warning(f"Rejected task OIDC token: {e}")
+        return False
+    return claims.get('email') == TASKS_SERVICE_ACCOUNT and claims.get('email_verified', False)
+
+def process_image_with_gemini(image_bytes, raise_on_error=False):
     """
     Process image bytes using Gemini AI and return title and description.
     Expects Gemini to return JSON directly based on the prompt and config.
+    With raise_on_error, failures raise instead of returning a placeholder
+    dict, so callers that can retry don't store the placeholder.
     """
     if not model:
         logging.warning("Gemini model not initialized. Cannot process image.")
+        if raise_on_error:
+            raise RuntimeError("AI model not available.")
         return {"title": "Error", "description": "AI model not available."}
 
     try:
-        # Open image from bytes
+        # Open image from bytes and downscale a copy for Gemini; the original goes to GCS
         img = Image.open(io.BytesIO(image_bytes))
-
-        # Send image and prompt to Gemini
-        response = model.generate_content([img, PROMPT])
+        max_size = (GEMINI_MAX_IMAGE_EDGE, GEMINI_MAX_IMAGE_EDGE)
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            # Shrink in RGBA first, then composite onto white at the reduced size,
+            # since JPEG has no alpha and dropping it turns transparent areas black
+            img = img.convert('RGBA')
+            img.thumbnail(max_size, Image.LANCZOS)
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        else:
+            if img.mode in ('P', '1'):
+                img = img.convert('RGB') # Resizing these modes falls back to nearest-neighbour
+            # Thumbnail before any other conversion so JPEGs are decoded at reduced size (draft)
+            img.thumbnail(max_size, Image.LANCZOS)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG', quality=GEMINI_JPEG_QUALITY)
+        image_part = {"mime_type": "image/jpeg", "data": buf.getvalue()}
+
+        # Send image to Gemini; the prompt is the model's system instruction
+        response = model.generate_content(image_part)
 
         logging.info(f"Gemini Raw Response: {response.text}") # Log the raw response
 
         # Gemini is configured to return JSON, so parse it directly
         if response and response.text:
-            try:
-                # Clean potential markdown backticks if they still appear
-                cleaned_text = response.text.strip().strip('```json').strip('```').strip()
-                json_data = json.loads(cleaned_text)
-                # Basic validation
-                if isinstance(json_data, dict) and 'title' in json_data and 'description' in json_data:
-                     logging.info(f"Successfully parsed Gemini JSON: {json_data}")
-                     return json_data
-                else:
-                    logging.warning(f"Gemini response was not the expected JSON format: {cleaned_text}")
-                    # Fallback if JSON structure is wrong
-                    return {"title": "Processing Error", "description": "Received invalid format from AI."}
-            except json.JSONDecodeError as e:
-                logging.error(f"Failed to decode Gemini JSON response: {e}. Response text: {response.text}")
-                # Fallback if JSON parsing fails
-                return {"title": "Processing Error", "description": f"Could not parse AI response: {response.text[:100]}..."} # Show partial response
-            except Exception as e_inner: # Catch other potential errors during parsing/validation
-                 logging.error(f"Error processing Gemini response content: {e_inner}. Response text: {response.text}")
-                 return {"title": "Processing Error", "description": f"Error processing AI response: {str(e_inner)}"}
+            return parse_description(response.text, raise_on_error)
         else:
             logging.warning("Gemini returned an empty or invalid response.")
+            if raise_on_error:
+                raise RuntimeError("Gemini returned an empty response.")
             return {"title": "Untitled", "description": "No description generated."}
 
     except Exception as e:
         logging.error(f"Error processing image with Gemini: {e}", exc_info=True) # Log stack trace
+        if raise_on_error:
+            raise
         return {"title": "Error", "description": f"Error during AI processing: {str(e)}"}
 
 
+def get_cached_gallery():
+    """Returns the cached gallery list, or None on a miss or if Redis is unavailable."""
+    if not redis_client:
+        return None
+    try:
+        cached = redis_client.get(GALLERY_CACHE_KEY)
+        return orjson.loads(cached) if cached else None
+    except redis.RedisError as e:
+        logging.warning(f"Redis GET failed for gallery cache: {e}")
+        return None
+
+def cache_gallery(image_data):
+    """Stores the gallery list in Redis for GALLERY_CACHE_TTL seconds."""
+    if not redis_client:
+        return
+    try:
+        redis_client.setex(GALLERY_CACHE_KEY, GALLERY_CACHE_TTL, orjson.dumps(image_data))
+    except redis.RedisError as e:
+        logging.warning(f"Failed to cache gallery in Redis: {e}")
+
+def invalidate_gallery_cache():
+    """Drops the cached gallery so the next index() reflects the bucket."""
+    if not redis_client:
+        return
+    try:
+        redis_client.delete(GALLERY_CACHE_KEY)
+    except redis.RedisError as e:
+        logging.warning(f"Failed to invalidate gallery cache: {e}")
+
+
 @app.route('/')
 def index():
     """Displays the main gallery page with image links."""
@@ -126,49 +376,30 @@ def index():
 
     image_data = []
     try:
-        blobs = list(bucket.list_blobs()) # Get all blobs once
+        cached = get_cached_gallery()
+        if cached is not None:
+            logging.info(f"Serving {len(cached)} images from the gallery cache.")
+            return render_template('index.html', image_data=cached)
+
+        blobs = list(bucket.list_blobs(fields=GALLERY_LIST_FIELDS, page_size=LIST_PAGE_SIZE)) # Get all blobs once
         logging.info(f"Found {len(blobs)} blobs in the bucket.")
 
-        image_files = [b for b in blobs if b.name.lower().endswith(tuple(ALLOWED_EXTENSIONS))]
+        image_files = [b for b in blobs if b.name.lower().endswith(ALLOWED_SUFFIXES)]
         logging.info(f"Found {len(image_files)} potential image files.")
 
-        # Create a dictionary of description blobs for quick lookup
-        description_blobs = {b.name: b for b in blobs if b.name.lower().endswith('_description.json')}
-        logging.info(f"Found {len(description_blobs)} potential description files.")
-
-
         for img_blob in image_files:
-            base_name = os.path.splitext(img_blob.name)[0]
-            desc_filename = f"{base_name}_description.json"
-            title = 'Untitled'
-            description = 'No description available'
-
-            # Check if the corresponding description JSON exists
-            if desc_filename in description_blobs:
-                desc_blob = description_blobs[desc_filename]
-                try:
-                    # Download and parse the description JSON
-                    desc_content = desc_blob.download_as_string()
-                    desc_json = json.loads(desc_content)
-                    title = desc_json.get('title', 'Untitled') # Use .get for safety
-                    description = desc_json.get('description', 'No description available')
-                    logging.debug(f"Successfully loaded description for {img_blob.name}")
-                except json.JSONDecodeError:
-                    logging.warning(f"Could not decode JSON for {desc_filename}. Content: {desc_content[:100]}...")
-                    description = 'Error loading description (invalid format).'
-                except Exception as e:
-                    logging.error(f"Error fetching/parsing description for {img_blob.name}: {e}")
-                    description = 'Error loading description.'
-            else:
-                 logging.warning(f"Description file {desc_filename} not found for image {img_blob.name}")
-
+            # Titles live in each image's custom metadata, returned by the listing itself
+            metadata = img_blob.metadata or {}
+            if 'title' not in metadata:
+                 logging.warning(f"No description metadata for image {img_blob.name}")
 
             image_data.append({
                 'filename': img_blob.name,
-                'title': title,
-                # 'description': description # No longer needed for the index page link
+                'title': metadata.get('title', 'Untitled'),
             })
 
+        cache_gallery(image_data)
+
     except Exception as e:
         logging.error(f"Error listing blobs or processing index data: {e}", exc_info=True)
         flash(f"Error retrieving image list: {str(e)}", "error")
@@ -199,32 +430,44 @@ def upload_file():
         # For simplicity, we'll stick with the original name here.
 
         try:
-            # Read file content into memory for processing and upload
+            # Read file content once; the same bytes feed the GCS upload and Gemini
             file_bytes = file.read()
-            file.seek(0) # Reset stream position if needed elsewhere, though not strictly necessary here
 
             # --- Upload Image to GCS ---
             blob = bucket.blob(filename)
-            # Use upload_from_string with content type for better handling
-            blob.upload_from_string(file_bytes, content_type=file.mimetype)
-            logging.info(f"Successfully uploaded image '{filename}' to GCS.")
 
-            # --- Process with Gemini AI ---
+            upload_future = None
+            if tasks_client:
+                # Describe in the background; the task reads the image back from GCS
+                blob.upload_from_string(file_bytes, content_type=file.mimetype)
+                logging.info(f"Successfully uploaded image '{filename}' to GCS.")
+                invalidate_gallery_cache()
+                try:
+                    enqueue_description(filename)
+                    flash(f"File '{filename}' uploaded! Its description is being generated.", 'success')
+                    return redirect(url_for('index'))
+                except Exception as e:
+                    # The image is already stored; describe it inline rather than leave it without one
+                    logging.error(f"Failed to enqueue description task for '{filename}', describing inline: {e}", exc_info=True)
+            else:
+                # Start the upload in the background; it doesn't depend on the AI result
+                upload_future = io_executor.submit(blob.upload_from_string, file_bytes, content_type=file.mimetype)
+
+            # --- Process with Gemini AI while the upload is in flight ---
             # Pass the image bytes directly
             description_data = process_image_with_gemini(file_bytes)
             logging.info(f"Received description data for '{filename}': {description_data}")
 
+            if upload_future:
+                upload_future.result() # Re-raises any upload error
+                logging.info(f"Successfully uploaded image '{filename}' to GCS.")
+                invalidate_gallery_cache()
 
-            # --- Upload Description JSON to GCS ---
+            # --- Store the description on the uploaded image ---
+            # Deliberately sequential: the metadata patch needs the object to exist,
+            # so it can't overlap the image upload the way a sidecar write could
             if description_data and isinstance(description_data, dict):
-                base_name = os.path.splitext(filename)[0]
-                json_filename = f"{base_name}_description.json"
-                description_blob = bucket.blob(json_filename)
-                description_blob.upload_from_string(
-                    json.dumps(description_data, indent=2),
-                    content_type='application/json'
-                )
-                logging.info(f"Successfully uploaded description JSON '{json_filename}' to GCS.")
+                save_description(filename, description_data)
                 flash(f"File '{filename}' uploaded and processed successfully!", 'success')
             else:
                  # Handle cases where Gemini processing failed but image was uploaded
@@ -242,6 +485,223 @@ def upload_file():
         flash('Invalid file type. Allowed types: png, jpg, jpeg, gif', 'warning')
         return redirect(url_for('index'))
 
+@app.route('/internal/describe/<filename>', methods=['POST'])
+def describe_image(filename):
+    """Cloud Tasks handler: generates and stores the description for an uploaded image."""
+    # Only Cloud Tasks, authenticating as TASKS_SERVICE_ACCOUNT, may trigger Gemini calls here
+    if not is_task_caller():
+        return "Forbidden", 403
+    if not bucket:
+        return "Storage bucket not configured.", 500
+
+    try:
+        # Pin the generation so a re-upload mid-task can't receive this image's description
+        img_blob = bucket.get_blob(filename)
+        if img_blob is None:
+            raise NotFound(f"Image {filename} not found.")
+        image_bytes = img_blob.download_as_bytes(if_generation_match=img_blob.generation)
+        # Raise on any Gemini failure so the task is retried rather than storing a placeholder
+        description_data = process_image_with_gemini(image_bytes, raise_on_error=True)
+        logging.info(f"Received description data for '{filename}': {description_data}")
+        save_description(filename, description_data, if_generation_match=img_blob.generation)
+        return "", 204
+    except (NotFound, PreconditionFailed):
+        # Deleted or replaced since the task was queued; a 2xx drops the task instead of retrying
+        logging.warning(f"Image {filename} was deleted or replaced, dropping description task.")
+        return "", 204
+    except Exception as e:
+        # A non-2xx response makes Cloud Tasks retry with backoff
+        logging.error(f"Error describing image {filename}: {e}", exc_info=True)
+        return f"Error describing image: {str(e)}", 500
+
+
+@app.route('/batch_reprocess', methods=['POST'])
+def batch_reprocess():
+    """
+    Submits a Vertex AI batch prediction job that regenerates the description
+    for every image in the bucket. Poll GET /batch_reprocess/<job_id>, then
+    POST /batch_reprocess/<job_id>/apply once it has succeeded.
+    """
+    if not is_admin_caller():
+        return {"error": "Forbidden."}, 403
+    if not bucket or not vertex_ready:
+        return {"error": "Storage or Vertex AI not configured."}, 500
+
+    try:
+        image_blobs = [b for b in bucket.list_blobs(fields="items(name,contentType,generation),nextPageToken", page_size=LIST_PAGE_SIZE)
+                       if allowed_file(b.name) and not b.name.startswith(BATCH_PREFIX)]
+        if not image_blobs:
+            return {"error": "No images to process."}, 400
+
+        # One request per image, referencing it in place rather than inlining the bytes
+        lines = []
+        for img_blob in image_blobs:
+            mime_type = img_blob.content_type or mimetypes.guess_type(img_blob.name)[0] or 'image/jpeg'
+            lines.append(orjson.dumps({"request": {
+                "contents": [{"role": "user", "parts": [
+                    {"fileData": {"fileUri": f"gs://{BUCKET_NAME}/{img_blob.name}", "mimeType": mime_type}},
+                ]}],
+                "systemInstruction": {"parts": [{"text": PROMPT}]},
+                "generationConfig": GENERATION_CONFIG,
+            }}))
+        # Generation of each image at submit time, so results never overwrite a newer upload
+        generations = {b.name: b.generation for b in image_blobs}
+
+        # Timestamp for readability, random suffix so concurrent submissions never share a run
+        run_prefix = f"{BATCH_PREFIX}{int(time.time())}-{uuid.uuid4().hex[:12]}"
+        input_name = f"{run_prefix}/input.jsonl"
+        bucket.blob(input_name).upload_from_string(b"\n".join(lines), content_type='application/jsonl')
+        bucket.blob(f"{run_prefix}/generations.json").upload_from_string(orjson.dumps(generations), content_type='application/json')
+
+        job = BatchPredictionJob.submit(
+            source_model=BATCH_MODEL,
+            input_dataset=f"gs://{BUCKET_NAME}/{input_name}",
+            output_uri_prefix=f"gs://{BUCKET_NAME}/{run_prefix}/output",
+        )
+        logging.info(f"Submitted batch job {job.resource_name} for {len(lines)} images.")
+        return {"job": job.resource_name, "job_id": job.name, "images": len(lines)}, 202
+
+    except Exception as e:
+        logging.error(f"Error submitting batch reprocess job: {e}", exc_info=True)
+        return {"error": f"Error submitting batch job: {str(e)}"}, 500
+
+
+@app.route('/batch_reprocess/<job_id>')
+def batch_reprocess_status(job_id):
+    """Reports the state of a batch job."""
+    if not is_admin_caller():
+        return {"error": "Forbidden."}, 403
+    if not vertex_ready:
+        return {"error": "Vertex AI not configured."}, 500
+
+    try:
+        job = BatchPredictionJob(job_id)
+        if not job.has_ended:
+            return {"state": job.state.name}, 202
+        if not job.has_succeeded:
+            return {"state": job.state.name, "error": str(job.error)}, 500
+        return {"state": job.state.name, "output": job.output_location}
+    except Exception as e:
+        logging.error(f"Error fetching batch job {job_id}: {e}", exc_info=True)
+        return {"error": f"Error fetching batch job: {str(e)}"}, 500
+
+
+@app.route('/batch_reprocess/<job_id>/apply', methods=['POST'])
+def batch_reprocess_apply(job_id):
+    """
+    Writes a succeeded batch job's predictions back as image descriptions.
+    Runs once per job; images re-uploaded since the job was submitted are skipped.
+    """
+    if not is_admin_caller():
+        return {"error": "Forbidden."}, 403
+    if not bucket or not vertex_ready:
+        return {"error": "Storage or Vertex AI not configured."}, 500
+
+    try:
+        job = BatchPredictionJob(job_id)
+        if not job.has_succeeded:
+            return {"state": job.state.name, "error": "Job has not succeeded."}, 409
+
+        # output_location looks like gs://<bucket>/batch/<run>/output/prediction-model-<timestamp>
+        output_prefix = job.output_location[len(f"gs://{BUCKET_NAME}/"):]
+        run_prefix = output_prefix.rsplit('/output/', 1)[0]
+
+        # Claim the job atomically so concurrent or repeated calls don't write twice
+        marker = bucket.blob(f"{run_prefix}/applied")
+        try:
+            marker.upload_from_string(job_id, if_generation_match=0)
+        except PreconditionFailed:
+            return {"state": job.state.name, "error": "Job results already applied."}, 409
+
+        try:
+            generations = orjson.loads(bucket.blob(f"{run_prefix}/generations.json").download_as_string())
+
+            results = {}
+            for out_blob in bucket.list_blobs(prefix=output_prefix, fields="items(name),nextPageToken"):
+                if not out_blob.name.endswith('.jsonl'):
+                    continue
+                for line in out_blob.download_as_string().splitlines():
+                    if not line.strip():
+                        continue
+                    try:
+                        prediction = orjson.loads(line)
+                        file_uri = prediction["request"]["contents"][0]["parts"][0]["fileData"]["fileUri"]
+                        filename = file_uri[len(f"gs://{BUCKET_NAME}/"):]
+                        text = prediction["response"]["candidates"][0]["content"]["parts"][0]["text"]
+                        # Raise on truncated/malformed output so it is skipped, not stored over a good description
+                        results[filename] = parse_description(text, raise_on_error=True)
+                    except (orjson.JSONDecodeError, KeyError, IndexError, TypeError) as e:
+                        logging.warning(f"Skipping unusable prediction line in {out_blob.name}: {e}")
+
+            def _apply(item):
+                filename, description_data = item
+                try:
+                    save_description(filename, description_data,
+                                     if_generation_match=generations[filename], invalidate=False)
+                    return True
+                except (PreconditionFailed, NotFound, KeyError):
+                    logging.info(f"Skipping '{filename}': replaced or deleted since the batch was submitted.")
+                    return False
+
+            # Write the descriptions concurrently, off the request-path I/O pool
+            with ThreadPoolExecutor(max_workers=BULK_WRITE_WORKERS, thread_name_prefix="bulk-write") as pool:
+                updated = sum(pool.map(_apply, results.items()))
+            invalidate_gallery_cache()
+        except Exception:
+            marker.delete() # Release the claim so the write-back can be retried
+            raise
+
+        logging.info(f"Batch job {job_id} wrote {updated} of {len(results)} descriptions.")
+        return {"state": job.state.name, "updated": updated, "skipped": len(results) - updated}
+
+    except Exception as e:
+        logging.error(f"Error applying batch job {job_id}: {e}", exc_info=True)
+        return {"error": f"Error applying batch job: {str(e)}"}, 500
+
+
+@app.route('/admin/migrate_descriptions', methods=['POST'])
+def migrate_descriptions():
+    """
+    Copies legacy <name>_description.json sidecars into the image blobs' metadata
+    for images that don't have a description there yet. Safe to run repeatedly.
+    """
+    if not is_admin_caller():
+        return {"error": "Forbidden."}, 403
+    if not bucket:
+        return {"error": "Storage bucket not configured."}, 500
+
+    try:
+        blobs = list(bucket.list_blobs(fields="items(name,generation,metadata),nextPageToken", page_size=LIST_PAGE_SIZE))
+        names = {b.name for b in blobs}
+        pending = [b for b in blobs
+                   if allowed_file(b.name) and 'title' not in (b.metadata or {})
+                   and f"{os.path.splitext(b.name)[0]}_description.json" in names]
+
+        def _migrate(img_blob):
+            json_filename = f"{os.path.splitext(img_blob.name)[0]}_description.json"
+            try:
+                description_data = orjson.loads(bucket.blob(json_filename).download_as_string())
+                save_description(img_blob.name, description_data,
+                                 if_generation_match=img_blob.generation, invalidate=False)
+                return True
+            except (PreconditionFailed, NotFound):
+                logging.info(f"Skipping '{img_blob.name}': replaced or deleted during migration.")
+            except Exception as e:
+                logging.error(f"Failed to migrate description for '{img_blob.name}': {e}")
+            return False
+
+        # Run off the request-path I/O pool so uploads aren't stuck behind the migration
+        with ThreadPoolExecutor(max_workers=BULK_WRITE_WORKERS, thread_name_prefix="bulk-write") as pool:
+            migrated = sum(pool.map(_migrate, pending))
+        invalidate_gallery_cache()
+        logging.info(f"Migrated {migrated} of {len(pending)} legacy descriptions to metadata.")
+        return {"migrated": migrated, "failed": len(pending) - migrated}
+
+    except Exception as e:
+        logging.error(f"Error migrating descriptions: {e}", exc_info=True)
+        return {"error": f"Error migrating descriptions: {str(e)}"}, 500
+
+
 # Renamed route for clarity
 @app.route('/view/<filename>')
 def view_image_details(filename):
@@ -253,26 +713,23 @@ def view_image_details(filename):
     description = "Could not load description."
     image_url = url_for('get_image_file', filename=filename) # Use a dedicated route for image serving
 
-    # Construct the expected description filename
-    base_name = os.path.splitext(filename)[0]
-    json_filename = f"{base_name}_description.json"
-    description_blob = bucket.blob(json_filename)
-
     try:
-        if description_blob.exists():
-            # Download and parse the description JSON
-            description_data_bytes = description_blob.download_as_string()
-            description_data = json.loads(description_data_bytes)
+        description_data = load_description(filename)
+        if description_data is not None:
             title = description_data.get('title', 'Untitled')
             description = description_data.get('description', 'No description available.')
             logging.info(f"Loaded title/description for {filename}")
         else:
-            logging.warning(f"Description file {json_filename} not found for image {filename}")
+            logging.warning(f"No description found for image {filename}")
             title = "Untitled"
-            description = "No description file found."
-
-    except json.JSONDecodeError:
-        logging.error(f"Failed to decode JSON for {json_filename}")
+            description = "No description found."
+
+    except NotFound:
+        logging.warning(f"Image {filename} not found")
+        title = "Untitled"
+        description = "No description found."
+    except orjson.JSONDecodeError:
+        logging.error(f"Failed to decode legacy description JSON for {filename}")
         description = "Error: Description file has invalid format."
     except Exception as e:
         logging.error(f"Error retrieving description for {filename}: {e}", exc_info=True)
@@ -287,28 +744,74 @@ def view_image_details(filename):
                            filename=filename)
 
 
+def image_url(blob):
+    """Returns a URL the browser can fetch the image from directly."""
+    if GCS_PUBLIC_BUCKET:
+        return blob.public_url
+
+    if signing_credentials is None:
+        raise RuntimeError("No signing credentials available.")
+
+    if isinstance(signing_credentials, Signing):
+        # Service account key: sign locally
+        return blob.generate_signed_url(version="v4", expiration=SIGNED_URL_TTL, method="GET",
+                                        credentials=signing_credentials)
+
+    # Metadata-server credentials (Cloud Run/App Engine) have no private key,
+    # so sign through the IAM signBlob API with a cloud-platform-scoped token
+    if not signing_credentials.valid:
+        signing_credentials.refresh(google.auth.transport.requests.Request())
+    return blob.generate_signed_url(
+        version="v4",
+        expiration=SIGNED_URL_TTL,
+        method="GET",
+        service_account_email=signing_credentials.service_account_email,
+        access_token=signing_credentials.token,
+    )
+
+
 # Renamed route for clarity and purpose
 @app.route('/image/<filename>')
 def get_image_file(filename):
-    """Serves the image file directly from GCS."""
+    """Redirects to the image in GCS, or serves it through the app if no URL can be issued."""
     if not bucket:
         return "Storage bucket not configured.", 500
 
+    global signing_suspended_until
+    blob = bucket.blob(filename)
+    if time.monotonic() >= signing_suspended_until:
+        try:
+            response = redirect(image_url(blob))
+            response.cache_control.private = True
+            response.cache_control.max_age = REDIRECT_MAX_AGE
+            return response
+        except Exception as e:
+            signing_suspended_until = time.monotonic() + SIGNING_RETRY_DELAY
+            logging.error(f"Could not issue a direct image URL, proxying images for the next {SIGNING_RETRY_DELAY}s. "
+                          f"On Cloud Run, check the service account has roles/iam.serviceAccountTokenCreator on itself "
+                          f"and the error below for scope or other causes: {e}")
+
     try:
-        blob = bucket.blob(filename)
-        if not blob.exists():
-             logging.warning(f"Image file not found in GCS: {filename}")
-             return "Image not found", 404
-
-        file_data = blob.download_as_bytes()
-
-        # Use Response for more control over headers if needed, or send_file
-        return send_file(
-            io.BytesIO(file_data),
-            mimetype=blob.content_type or 'application/octet-stream', # Provide default mimetype
-            # as_attachment=False, # Display inline by default
-            download_name=filename # Suggest filename if user saves
+        # Fetch metadata only; raises NotFound for a missing image and gives us the ETag
+        blob.reload()
+
+        def generate():
+            with blob.open("rb", chunk_size=IMAGE_STREAM_CHUNK_SIZE) as reader:
+                while chunk := reader.read(IMAGE_STREAM_CHUNK_SIZE):
+                    yield chunk
+
+        response = Response(
+            generate(),
+            mimetype=blob.content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream', # Provide default mimetype
         )
+        response.headers.set('Content-Disposition', 'inline', filename=filename) # Suggest filename if user saves
+        response.set_etag(blob.etag)
+        response.last_modified = blob.updated
+        # Answers If-None-Match/If-Modified-Since with a 304 without ever reading the body
+        return response.make_conditional(request)
+    except NotFound:
+        logging.warning(f"Image file not found in GCS: {filename}")
+        return "Image not found", 404
     except Exception as e:
         logging.error(f"Error serving image file {filename}: {e}", exc_info=True)
         # Don't flash here as it might redirect unexpectedly
@@ -325,17 +828,14 @@ def get_description_json(filename):
         return {"error": "Storage bucket not configured."}, 500
 
      try:
-        base_name = os.path.splitext(filename)[0]
-        json_filename = f"{base_name}_description.json"
-        blob = bucket.blob(json_filename)
-
-        if not blob.exists():
-             return {"error": "Description not found."}, 404
-
-        description_data = json.loads(blob.download_as_string())
+        description_data = load_description(filename)
+        if description_data is None:
+            return {"error": "Description not found."}, 404
         return description_data # Flask automatically jsonify's dicts
 
-     except json.JSONDecodeError:
+     except NotFound:
+         return {"error": "Description not found."}, 404
+     except orjson.JSONDecodeError:
          return {"error": "Invalid description format."}, 500
      except Exception as e:
         logging.error(f"Error retrieving description JSON for {filename}: {e}", exc_info=True)
@@ -0,0 +1,58 @@
+import os
+import sys
+from unittest import mock
+
+import orjson
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+main = pytest.importorskip("main")
+
+
+def _prediction_line(filename, text):
+    return orjson.dumps({
+        "request": {"contents": [{"role": "user", "parts": [
+            {"fileData": {"fileUri": f"gs://{main.BUCKET_NAME}/{filename}", "mimeType": "image/jpeg"}},
+        ]}]},
+        "response": {"candidates": [{"content": {"parts": [{"text": text}]}, "finishReason": "STOP"}]},
+    })
+
+
+def test_apply_skips_malformed_prediction_and_keeps_existing_metadata(monkeypatch):
+    run_prefix = "batch/run1"
+    output_prefix = f"{run_prefix}/output/prediction-model-1"
+
+    output_blob = mock.MagicMock()
+    output_blob.name = f"{output_prefix}/predictions.jsonl"
+    output_blob.download_as_string.return_value = b"\n".join([
+        # Truncated output, e.g. finishReason MAX_TOKENS
+        _prediction_line("cat.jpg", '{"title": "A sleeping c'),
+        _prediction_line("dog.jpg", '{"title": "Dog", "description": "A dog in a park."}'),
+    ])
+
+    generations_blob = mock.MagicMock()
+    generations_blob.download_as_string.return_value = orjson.dumps({"cat.jpg": 5, "dog.jpg": 7})
+    blobs = {f"{run_prefix}/generations.json": generations_blob}
+
+    bucket = mock.MagicMock()
+    bucket.blob.side_effect = lambda name: blobs.setdefault(name, mock.MagicMock())
+    bucket.list_blobs.return_value = [output_blob]
+
+    job = mock.MagicMock(has_succeeded=True, output_location=f"gs://{main.BUCKET_NAME}/{output_prefix}")
+    job.state.name = "JOB_STATE_SUCCEEDED"
+
+    monkeypatch.setattr(main, "bucket", bucket)
+    monkeypatch.setattr(main, "vertex_ready", True)
+    monkeypatch.setattr(main, "redis_client", None)
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(main, "BatchPredictionJob", mock.MagicMock(return_value=job))
+
+    response = main.app.test_client().post(
+        "/batch_reprocess/123/apply", headers={"Authorization": "Bearer secret"})
+
+    assert response.status_code == 200
+    assert response.get_json()["updated"] == 1
+    # The malformed prediction must not overwrite the existing description
+    assert "cat.jpg" not in blobs or not blobs["cat.jpg"].patch.called
+    blobs["dog.jpg"].patch.assert_called_once_with(if_generation_match=7)
+    assert blobs["dog.jpg"].metadata == {"title": "Dog", "description": "A dog in a park."}